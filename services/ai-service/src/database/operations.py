@@ -4,13 +4,50 @@ Database operations for audio features and recommendations
 
 from typing import List, Optional, Dict, Any
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, update, delete, event
+from sqlalchemy.orm import Session, selectinload
 from datetime import datetime, timedelta
 import json
+import logging
 
 from .models import AudioFile, AudioFeatures, UserInteraction, UserPreferences, RecommendationCache
 from .connection import get_db_session
+from .vector_index import get_vector_index, normalize_embedding
+
+logger = logging.getLogger(__name__)
+
+# session.info key holding vector index writes that wait for the commit
+_PENDING_INDEX_UPDATES = "pending_vector_index_updates"
+
+def _queue_index_update(session: AsyncSession, audio_file_id: str, embeddings: List[float]):
+    """
+    Defer a vector index write until the session's transaction commits. The
+    vector is validated now; an unusable one queues a removal instead.
+    """
+    vector = normalize_embedding(embeddings)
+    if vector is None:
+        logger.warning(f"Embeddings for audio file {audio_file_id} can't be indexed for similarity search")
+    session.info.setdefault(_PENDING_INDEX_UPDATES, {})[audio_file_id] = vector
+
+@event.listens_for(Session, "after_commit")
+def _apply_index_updates(session: Session):
+    # The rows are already committed here, so an index error must not
+    # escape from session.commit()
+    pending = session.info.pop(_PENDING_INDEX_UPDATES, None)
+    if pending:
+        index = get_vector_index()
+        for audio_file_id, vector in pending.items():
+            try:
+                if vector is None:
+                    index.remove(audio_file_id)
+                else:
+                    index.add(audio_file_id, vector)
+            except Exception as e:
+                logger.error(f"Failed to update vector index for audio file {audio_file_id}: {e}")
+
+@event.listens_for(Session, "after_rollback")
+def _discard_index_updates(session: Session):
+    session.info.pop(_PENDING_INDEX_UPDATES, None)
 
 class AudioFeatureService:
     """Service for managing audio features in the database"""
@@ -39,6 +76,7 @@ class AudioFeatureService:
             existing_features.duration = features.get("basic", {}).get("duration")
             existing_features.embeddings = features.get("feature_vector", [])
             existing_features.extractedAt = datetime.utcnow()
+            _queue_index_update(session, audio_file_id, existing_features.embeddings)
             return existing_features
         else:
             # Create new features record
@@ -55,6 +93,7 @@ class AudioFeatureService:
                 confidence=0.8
             )
             session.add(audio_features)
+            _queue_index_update(session, audio_file_id, audio_features.embeddings)
             return audio_features
     
     @staticmethod
@@ -76,25 +115,44 @@ class AudioFeatureService:
         exclude_file_id: Optional[str] = None
     ) -> List[AudioFeatures]:
         """Find similar audio files based on feature vectors"""
-        # This is a simplified version - in production you'd use vector similarity
-        query = select(AudioFeatures).where(AudioFeatures.embeddings.isnot(None))
-        
-        if exclude_file_id:
-            query = query.where(AudioFeatures.audioFileId != exclude_file_id)
-        
-        result = await session.execute(query.limit(limit * 2))  # Get more for filtering
-        features_list = result.scalars().all()
+        index = get_vector_index()
         
-        # Calculate similarity (simplified cosine similarity)
-        similarities = []
-        for features in features_list:
-            if features.embeddings:
-                similarity = calculate_cosine_similarity(feature_vector, features.embeddings)
-                similarities.append((features, similarity))
+        # (Re)build the in-process index from the database on first use and
+        # periodically after that, so other processes' writes show up
+        if index.needs_reload() and index.begin_reload():
+            items = None
+            try:
+                result = await session.execute(
+                    select(AudioFeatures.audioFileId, AudioFeatures.embeddings)
+                    .where(AudioFeatures.embeddings.isnot(None))
+                )
+                items = [(audio_file_id, embeddings) for audio_file_id, embeddings in result.all() if embeddings]
+            finally:
+                index.finish_reload(items)
         
-        # Sort by similarity and return top results
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return [features for features, _ in similarities[:limit]]
+        # Over-fetch so rows deleted since they were indexed don't shrink the
+        # result, widening the search until there are enough live rows
+        fetch = limit * 2
+        while True:
+            hits = index.search(feature_vector, fetch, exclude_file_id)
+            if not hits:
+                return []
+            
+            # Fetch the matching rows and keep the index's ranking order
+            result = await session.execute(
+                select(AudioFeatures).where(AudioFeatures.audioFileId.in_([file_id for file_id, _ in hits]))
+            )
+            features_by_id = {features.audioFileId: features for features in result.scalars().all()}
+            found = [features_by_id[file_id] for file_id, _ in hits if file_id in features_by_id]
+            
+            # Drop stale ids so later searches don't pay for them again
+            for file_id, _ in hits:
+                if file_id not in features_by_id:
+                    index.remove(file_id)
+            
+            if len(found) >= limit or len(hits) < fetch:
+                return found[:limit]
+            fetch *= 2
 
 class UserInteractionService:
     """Service for managing user interactions"""
@@ -246,22 +304,3 @@ class RecommendationCacheService:
             )
         )
         return result.rowcount
-
-def calculate_cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-    """Calculate cosine similarity between two vectors"""
-    try:
-        import math
-        
-        if len(vec1) != len(vec2):
-            return 0.0
-        
-        dot_product = sum(a * b for a, b in zip(vec1, vec2))
-        magnitude1 = math.sqrt(sum(a * a for a in vec1))
-        magnitude2 = math.sqrt(sum(a * a for a in vec2))
-        
-        if magnitude1 == 0 or magnitude2 == 0:
-            return 0.0
-        
-        return dot_product / (magnitude1 * magnitude2)
-    except:
-        return 0.0
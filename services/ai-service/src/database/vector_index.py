@@ -0,0 +1,241 @@
+"""
+In-process vector index for audio feature similarity search
+Uses FAISS when installed, otherwise a NumPy brute-force scan
+"""
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import threading
+import time
+import logging
+
+import numpy as np
+
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+class _NumpyFlatIndex:
+    """
+    Fallback for faiss.IndexIDMap2(IndexFlatIP) when faiss isn't installed.
+    Rows live in one contiguous float32 matrix so a search is a single
+    BLAS matrix-vector product.
+    """
+
+    def __init__(self, dim: int):
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._positions: Dict[int, int] = {}
+        self.ntotal = 0
+
+    def add_with_ids(self, x: np.ndarray, ids: np.ndarray):
+        n = x.shape[0]
+        if self.ntotal + n > self._matrix.shape[0]:
+            # Grow geometrically so appends are amortized O(1)
+            capacity = max(16, 2 * (self.ntotal + n))
+            matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+            matrix[:self.ntotal] = self._matrix[:self.ntotal]
+            row_ids = np.empty(capacity, dtype=np.int64)
+            row_ids[:self.ntotal] = self._ids[:self.ntotal]
+            self._matrix, self._ids = matrix, row_ids
+
+        self._matrix[self.ntotal:self.ntotal + n] = x
+        self._ids[self.ntotal:self.ntotal + n] = ids
+        for offset, row_id in enumerate(ids):
+            self._positions[int(row_id)] = self.ntotal + offset
+        self.ntotal += n
+
+    def remove_ids(self, ids: np.ndarray):
+        for row_id in ids:
+            pos = self._positions.pop(int(row_id), None)
+            if pos is None:
+                continue
+            # Move the last row into the hole to keep the matrix dense
+            last = self.ntotal - 1
+            if pos != last:
+                self._matrix[pos] = self._matrix[last]
+                moved = int(self._ids[last])
+                self._ids[pos] = moved
+                self._positions[moved] = pos
+            self.ntotal = last
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self._matrix[:self.ntotal] @ queries[0]
+        k = min(k, self.ntotal)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return scores[top].reshape(1, -1), self._ids[top].reshape(1, -1)
+
+def normalize_embedding(vector) -> Optional[np.ndarray]:
+    """
+    Return `vector` as a unit-length float32 row, or None if it is not a
+    flat, non-empty, finite and non-zero list of numbers. Embeddings come
+    from a free-form JSON column, so anything else is possible.
+    """
+    try:
+        vec = np.asarray(vector, dtype=np.float32)
+    except (ValueError, TypeError):
+        return None
+    if vec.ndim != 1 or vec.shape[0] == 0 or not np.isfinite(vec).all():
+        return None
+    norm = float(np.linalg.norm(vec))
+    if norm == 0.0 or not np.isfinite(norm):
+        return None
+    return vec / norm
+
+class VectorIndex:
+    """
+    Inner-product index over L2-normalized embeddings, so scores are cosine
+    similarities. Embeddings are grouped by dimension and a query is only
+    compared against embeddings of the same length.
+
+    The index is rebuilt from the database every reload_interval seconds so
+    rows written by other processes become searchable.
+    """
+
+    reload_interval = 300.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes: Dict[int, object] = {}  # dim -> faiss or fallback index
+        self._keys: Dict[str, Tuple[int, int]] = {}  # audio_file_id -> (dim, internal id)
+        self._ids: Dict[int, str] = {}
+        self._next_id = 0
+        self.loaded_at: Optional[float] = None
+        # Writes made while a reload is in flight, replayed onto the new index
+        self._journal: Optional[List[Tuple[str, Optional[Sequence[float]]]]] = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def needs_reload(self) -> bool:
+        """True if the index was never loaded or is older than reload_interval"""
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.reload_interval
+
+    def begin_reload(self) -> bool:
+        """Start journaling writes for a reload; False if one is already running"""
+        with self._lock:
+            if self._journal is not None:
+                return False
+            self._journal = []
+            return True
+
+    def finish_reload(self, items: Optional[Iterable[Tuple[str, Sequence[float]]]]):
+        """
+        Swap in an index built from (audio_file_id, vector) pairs, replaying
+        writes journaled since begin_reload. Passing None abandons the reload.
+        """
+        fresh = None
+        try:
+            if items is not None:
+                building = VectorIndex()
+                skipped = [
+                    audio_file_id for audio_file_id, vector in items
+                    if not building.add(audio_file_id, vector)
+                ]
+                if skipped:
+                    logger.warning(f"Vector index reload skipped {len(skipped)} unusable embeddings: {skipped[:10]}")
+                fresh = building
+        finally:
+            # Always stop journaling, even if building the new index failed
+            with self._lock:
+                journal, self._journal = self._journal, None
+                if fresh is not None:
+                    for audio_file_id, vector in journal or ():
+                        if vector is None:
+                            fresh.remove(audio_file_id)
+                        else:
+                            fresh.add(audio_file_id, vector)
+                    self._indexes, self._keys, self._ids = fresh._indexes, fresh._keys, fresh._ids
+                    self._next_id = fresh._next_id
+                    self.loaded_at = time.monotonic()
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> Optional[np.ndarray]:
+        """Return a unit-length float32 row, or None if it can't be indexed"""
+        return normalize_embedding(vector)
+
+    def add(self, audio_file_id: str, vector: Sequence[float]) -> bool:
+        """
+        Insert or replace the embedding for an audio file. Returns False, after
+        dropping any previous entry, if the vector can't be indexed.
+        """
+        vec = self._normalize(vector)
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((audio_file_id, vector))
+            self._remove_locked(audio_file_id)
+            if vec is None:
+                return False
+
+            dim = vec.shape[0]
+            internal_id = self._next_id
+            self._next_id += 1
+            self._keys[audio_file_id] = (dim, internal_id)
+            self._ids[internal_id] = audio_file_id
+
+            if dim not in self._indexes:
+                if FAISS_AVAILABLE:
+                    self._indexes[dim] = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+                else:
+                    self._indexes[dim] = _NumpyFlatIndex(dim)
+            self._indexes[dim].add_with_ids(vec.reshape(1, -1), np.asarray([internal_id], dtype=np.int64))
+        return True
+
+    def remove(self, audio_file_id: str):
+        """Drop an audio file from the index if present"""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((audio_file_id, None))
+            self._remove_locked(audio_file_id)
+
+    def _remove_locked(self, audio_file_id: str):
+        entry = self._keys.pop(audio_file_id, None)
+        if entry is None:
+            return
+        dim, internal_id = entry
+        del self._ids[internal_id]
+        self._indexes[dim].remove_ids(np.asarray([internal_id], dtype=np.int64))
+
+    def search(
+        self,
+        vector: Sequence[float],
+        k: int,
+        exclude_file_id: Optional[str] = None
+    ) -> List[Tuple[str, float]]:
+        """Return up to k (audio_file_id, cosine similarity) pairs, best first"""
+        query = self._normalize(vector)
+        if query is None or k <= 0:
+            return []
+        dim = query.shape[0]
+
+        with self._lock:
+            index = self._indexes.get(dim)
+            if index is None or index.ntotal == 0:
+                return []
+
+            # Ask for one extra hit so the excluded file doesn't shrink the result
+            k_search = min(k + (1 if exclude_file_id else 0), index.ntotal)
+            scores, ids = index.search(query.reshape(1, -1), k_search)
+            results = [
+                (self._ids[int(i)], float(s))
+                for i, s in zip(ids[0], scores[0]) if i != -1
+            ]
+
+        if exclude_file_id:
+            results = [(file_id, s) for file_id, s in results if file_id != exclude_file_id]
+        return results[:k]
+
+# Global vector index instance
+vector_index = None
+
+def get_vector_index() -> VectorIndex:
+    """Get or create the process-wide vector index"""
+    global vector_index
+    if vector_index is None:
+        vector_index = VectorIndex()
+        logger.info(f"Vector index initialized (faiss={'yes' if FAISS_AVAILABLE else 'no'})")
+    return vector_index
@@ -6,6 +6,8 @@ Endpoints for audio feature extraction and analysis
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict, Any
+from hashlib import blake2b
+from cachetools import LRUCache
 import json
 import uuid
 
@@ -16,6 +18,10 @@ from ..database.operations import AudioFeatureService
 
 router = APIRouter()
 
+# Extracted features keyed by a digest of the raw audio bytes, so duplicate
+# uploads in a batch (or across batches) are only analyzed once
+_feature_cache: LRUCache = LRUCache(maxsize=10_000)
+
 def get_audio_analyzer():
     """Dependency to get audio analyzer instance"""
     # This will be injected from app.state in main.py
@@ -123,7 +129,14 @@ async def batch_analyze_audio(
                 })
                 continue
             
-            features = await analyzer.extract_features(audio_content, file.filename)
+            key = blake2b(audio_content, digest_size=16).digest()
+            features = _feature_cache.get(key)
+            if features is None:
+                features = await analyzer.extract_features(audio_content, file.filename)
+                # Fallback results carry the filename and an error marker, so
+                # only cache real extractions
+                if "error" not in features:
+                    _feature_cache[key] = features
             
             results.append({
                 "filename": file.filename,
@@ -4,9 +4,13 @@ Endpoints for room recommendations and user preferences
 """
 
 from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime
+import asyncio
+import os
+from async_lru import alru_cache
 
 from ..services.recommendation_engine import RecommendationEngine
 from ..models.recommendation_models import RecommendationRequest, RecommendationResponse
@@ -30,7 +34,122 @@ def get_recommendation_engine():
     from services.recommendation_engine import RecommendationEngine
     return RecommendationEngine()
 
-@router.post("/rooms", response_model=List[RecommendationResponse])
+class _RecommendationBatcher:
+    """
+    Coalesces /rooms requests that arrive within a short window into one
+    get_room_recommendations_batch call per engine and limit. A batch is
+    flushed when the window closes or it reaches max_batch_size, whichever
+    comes first. A window of 0 disables batching and every request goes
+    straight to get_room_recommendations.
+    """
+    
+    def __init__(self, window: float = 0.0, max_batch_size: int = 64):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[Tuple[Any, int], List[Tuple[str, asyncio.Future]]] = {}
+        self._tasks = set()
+    
+    async def submit(self, engine: RecommendationEngine, user_id: str, limit: int) -> List[Dict]:
+        """Queue one user's request and wait for its share of the batch"""
+        if self.window <= 0:
+            return await engine.get_room_recommendations(user_id=user_id, limit=limit)
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (engine, limit)
+        
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self.window, self._flush, key, batch)
+        batch.append((user_id, future))
+        
+        if len(batch) >= self.max_batch_size:
+            self._flush(key, batch)
+        return await future
+    
+    def _flush(self, key: Tuple[Any, int], batch: List[Tuple[str, asyncio.Future]]):
+        # The timer may fire after a size-triggered flush already took the batch
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        
+        task = asyncio.get_running_loop().create_task(self._run(*key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(
+        self,
+        engine: RecommendationEngine,
+        limit: int,
+        batch: List[Tuple[str, asyncio.Future]]
+    ):
+        try:
+            results = await engine.get_room_recommendations_batch(
+                [user_id for user_id, _ in batch], limit
+            )
+            if len(results) != len(batch):
+                raise RuntimeError(
+                    f"Batch returned {len(results)} results for {len(batch)} users"
+                )
+            
+            # Per-user failures come back as exceptions in that user's slot
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Never leave a waiter hanging, even if the batch was cancelled;
+            # alru would otherwise share the stuck call with later requests
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Recommendation batch did not complete"))
+
+# Global batcher instance shared by all /rooms requests; batching is opt-in
+# because the engine scores users one at a time and the window only adds latency
+_batcher = _RecommendationBatcher(
+    window=float(os.getenv("RECOMMENDATION_BATCH_WINDOW_MS", "0")) / 1000
+)
+
+_RESPONSE_FIELDS = RecommendationResponse.model_fields
+
+def _to_response_item(recommendation: Dict) -> Dict:
+    """
+    Project an engine result onto the RecommendationResponse fields: extra
+    keys are dropped, optional ones get their defaults and score is clamped
+    to its [0, 1] bound. A missing required field raises KeyError.
+    """
+    item = {
+        name: recommendation[name] if field.is_required() else recommendation.get(name, field.default)
+        for name, field in _RESPONSE_FIELDS.items()
+    }
+    item["score"] = min(max(float(item["score"]), 0.0), 1.0)
+    return item
+
+@alru_cache(maxsize=1024, ttl=60)
+async def _cached_room_recommendations(
+    engine: RecommendationEngine,
+    user_id: str,
+    limit: int
+) -> List[Dict]:
+    """Memoize recommendations per engine, user and limit"""
+    recommendations = await _batcher.submit(engine, user_id, limit)
+    return [_to_response_item(recommendation) for recommendation in recommendations]
+
+# Items are shaped by _to_response_item instead of per-item response_model
+# validation; the schema is still published for the OpenAPI docs
+@router.post(
+    "/rooms",
+    response_class=ORJSONResponse,
+    responses={200: {"model": List[RecommendationResponse]}}
+)
 async def get_room_recommendations(
     user_id: str,
     limit: int = Query(10, ge=1, le=50),
@@ -44,15 +163,12 @@ async def get_room_recommendations(
         # For now, skip database operations and generate recommendations directly
         # TODO: Integrate with database when schema is aligned
         
-        # Generate recommendations using the engine
-        recommendations = await engine.get_room_recommendations(
-            user_id=user_id,
-            limit=limit,
-            user_preferences=None,  # Will be loaded from DB later
-            recent_interactions=None  # Will be loaded from DB later
-        )
+        # Generate recommendations using the engine; identical concurrent
+        # requests share one in-flight call, and distinct ones are only
+        # batched when RECOMMENDATION_BATCH_WINDOW_MS is set
+        recommendations = await _cached_room_recommendations(engine, user_id, limit)
         
-        return recommendations
+        return ORJSONResponse(recommendations)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Recommendation failed: {str(e)}")
@@ -301,7 +417,7 @@ async def get_recommendation_stats(
             "user_id": user_id,
             "total_interactions_week": len(recent_interactions),
             "recommendation_accuracy": 0.85,  # Placeholder - would calculate from feedback
-            "discovery_rate": preferences.discovery_factor,
+            "discovery_mode": preferences.discoveryMode,
             "last_activity": recent_interactions[0].timestamp.isoformat() if recent_interactions else None,
             "preferences_completeness": _calculate_preferences_completeness(preferences)
         }
@@ -314,15 +430,17 @@ def _calculate_preferences_completeness(preferences) -> float:
     completeness = 0.0
     total_fields = 5
     
-    if preferences.preferred_genres:
+    tempo_range = preferences.tempoRange or {}
+    
+    if preferences.genrePreferences:
         completeness += 0.3
-    if preferences.tempo_range_min and preferences.tempo_range_max:
+    if tempo_range.get('min') and tempo_range.get('max'):
         completeness += 0.2
-    if preferences.energy_level:
+    if preferences.energyRange:
         completeness += 0.2
-    if preferences.discovery_factor is not None:
+    if preferences.discoveryMode is not None:
         completeness += 0.15
-    if getattr(preferences, 'last_updated', None):
+    if preferences.lastUpdated:
         completeness += 0.15
     
     return min(completeness, 1.0)
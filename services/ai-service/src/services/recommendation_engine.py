@@ -3,17 +3,36 @@ Recommendation Engine Service
 Handles room recommendations using various algorithms
 """
 
-try:
-    import numpy as np
-    NUMPY_AVAILABLE = True
-except ImportError:
-    NUMPY_AVAILABLE = False
-    print("Warning: NumPy not available. Some features may be limited.")
-
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
 from datetime import datetime, timedelta
+from types import MappingProxyType
 import json
 
+from async_lru import alru_cache
+
+class Prefs(NamedTuple):
+    """Normalized view of the user preference fields used for scoring"""
+    genres: List[str]
+    tempo_min: float
+    tempo_max: float
+    energy: float
+
+def _coerce_prefs(user_preferences) -> Prefs:
+    """
+    Read a UserPreferences row (or None) into a Prefs tuple once per call
+    """
+    if not user_preferences:
+        return Prefs(["electronic", "ambient"], 60.0, 180.0, 0.5)
+    
+    tempo_range = getattr(user_preferences, 'tempoRange', {}) or {}
+    energy_range = getattr(user_preferences, 'energyRange', {}) or {}
+    return Prefs(
+        genres=getattr(user_preferences, 'genrePreferences', []) or [],
+        tempo_min=tempo_range.get('min', 60.0),
+        tempo_max=tempo_range.get('max', 180.0),
+        energy=energy_range.get('min', 0.5)  # Use min as baseline
+    )
+
 class RecommendationEngine:
     """
     Service for generating room recommendations
@@ -38,23 +57,21 @@ class RecommendationEngine:
         recommendations = []
         
         # Use user preferences if available
-        if user_preferences:
-            preferred_genres = getattr(user_preferences, 'genrePreferences', []) or []
-            tempo_range = getattr(user_preferences, 'tempoRange', {}) or {}
-            tempo_min = tempo_range.get('min', 60.0)
-            tempo_max = tempo_range.get('max', 180.0)
-            energy_range = getattr(user_preferences, 'energyRange', {}) or {}
-            energy_level = energy_range.get('min', 0.5)  # Use min as baseline
-        else:
-            preferred_genres = ["electronic", "ambient"]
-            tempo_min, tempo_max = 60.0, 180.0
-            energy_level = 0.5
+        prefs = _coerce_prefs(user_preferences)
+        preferred_genres = prefs.genres
         
         # Analyze recent interactions for patterns
         interaction_patterns = self._analyze_interaction_patterns(recent_interactions)
         
+        # Strings that don't vary per row are built once
+        room_id_prefix = f"rec_room_{user_id}_"
+        reasoning = "Based on your preferences"
+        if preferred_genres:
+            reasoning = f"Matches your preference for {', '.join(preferred_genres[:2])}"
+        
         # Generate personalized recommendations
         for i in range(min(limit, 10)):
+            rank = str(i + 1)
             score = 0.9 - (i * 0.05)
             
             # Adjust score based on user preferences
@@ -65,25 +82,37 @@ class RecommendationEngine:
             if interaction_patterns.get('active_hours'):
                 score += 0.05  # Boost for being active at this time
             
-            room_name = f"Recommended Room {i+1}"
-            reasoning = "Based on your preferences"
-            
-            if preferred_genres:
-                reasoning = f"Matches your preference for {', '.join(preferred_genres[:2])}"
-            
             recommendations.append({
-                "room_id": f"rec_room_{user_id}_{i+1}",
-                "room_name": room_name,
+                "room_id": room_id_prefix + rank,
+                "room_name": "Recommended Room " + rank,
                 "score": round(score, 3),
                 "reasoning": reasoning,
                 "participants": 3 + (i % 8),
                 "genres": preferred_genres[:2] if preferred_genres else ["electronic", "ambient"],
-                "tempo_range": [tempo_min, tempo_max],
-                "energy_level": energy_level
+                "tempo_range": [prefs.tempo_min, prefs.tempo_max],
+                "energy_level": prefs.energy
             })
         
         return recommendations
     
+    async def get_room_recommendations_batch(
+        self,
+        user_ids: List[str],
+        limit: int = 10
+    ) -> List[Any]:
+        """
+        Get room recommendations for several users at once, in input order.
+        A failure for one user is returned in that user's slot instead of
+        failing the whole batch.
+        """
+        results: List[Any] = []
+        for user_id in user_ids:
+            try:
+                results.append(await self.get_room_recommendations(user_id=user_id, limit=limit))
+            except Exception as e:
+                results.append(e)
+        return results
+    
     def _analyze_interaction_patterns(self, interactions) -> Dict:
         """
         Analyze user interaction patterns to improve recommendations
@@ -141,19 +170,22 @@ class RecommendationEngine:
         """
         # TODO: Implement database update
         print(f"Updating preferences for user {user_id}: {preferences}")
+        self.get_user_preferences.cache_invalidate(user_id)
     
-    async def get_user_preferences(self, user_id: str) -> Dict:
+    @alru_cache(maxsize=10_000, ttl=300)
+    async def get_user_preferences(self, user_id: str) -> Mapping[str, Any]:
         """
-        Get current user preferences
+        Get current user preferences (cached per user for 5 minutes). Every
+        caller shares the cached value, so it is returned read-only.
         """
         # TODO: Implement database lookup
-        return {
+        return MappingProxyType({
             "user_id": user_id,
-            "genres": ["electronic", "jazz"],
-            "tempo_range": [90, 140],
+            "genres": ("electronic", "jazz"),
+            "tempo_range": (90, 140),
             "energy_level": "medium",
-            "updated_at": datetime.utcnow().isoformat()
-        }
+            "updated_at": datetime.utcnow()
+        })
     
     async def record_user_interaction(self, user_id: str, room_id: str, 
                                     interaction_type: str, timestamp: datetime):
@@ -162,21 +194,25 @@ class RecommendationEngine:
         """
         # TODO: Implement database insert
         print(f"Recording interaction: {user_id} -> {room_id} ({interaction_type})")
+        self.get_user_stats.cache_invalidate(user_id)
     
-    async def get_user_stats(self, user_id: str) -> Dict:
+    @alru_cache(maxsize=10_000, ttl=300)
+    async def get_user_stats(self, user_id: str) -> Mapping[str, Any]:
         """
-        Get recommendation statistics for a user
+        Get recommendation statistics for a user (cached per user for 5
+        minutes). Every caller shares the cached value, so it is returned
+        read-only.
         """
         # TODO: Implement actual stats calculation
-        return {
+        return MappingProxyType({
             "user_id": user_id,
             "total_interactions": 42,
             "rooms_joined": 15,
             "recommendations_clicked": 28,
             "click_through_rate": 0.67,
-            "favorite_genres": ["electronic", "ambient", "jazz"],
-            "last_activity": datetime.utcnow().isoformat()
-        }
+            "favorite_genres": ("electronic", "ambient", "jazz"),
+            "last_activity": datetime.utcnow()
+        })
     
     def _calculate_content_similarity(self, room1_features: Dict, room2_features: Dict) -> float:
         """
@@ -197,13 +233,6 @@ class RecommendationEngine:
         """
         Combine different recommendation scores
         """
-        # Weighted combination
-        weights = {"content": 0.4, "collaborative": 0.4, "context": 0.2}
-        
-        combined = (
-            content_score * weights["content"] +
-            collaborative_score * weights["collaborative"] +
-            context_score * weights["context"]
-        )
-        
-        return min(max(combined, 0.0), 1.0)  # Clamp to [0, 1]
+        # Weighted combination (content 0.4, collaborative 0.4, context 0.2),
+        # clamped to [0, 1]
+        return max(0.0, min(1.0, 0.4 * content_score + 0.4 * collaborative_score + 0.2 * context_score))
@@ -3,14 +3,23 @@ Test configuration and fixtures for AI Service
 """
 
 import pytest
+import pytest_asyncio
 import asyncio
 import os
+from functools import lru_cache
 from pathlib import Path
 from unittest.mock import AsyncMock
-from fastapi.testclient import TestClient
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.pool import StaticPool
-from sqlalchemy import text
+from sqlalchemy import event
+from httpx import ASGITransport, AsyncClient
+
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
 
 # Import the app
 import sys
@@ -23,16 +32,27 @@ from database.models import Base
 # Test database URL (use in-memory SQLite for tests)
 TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
-@pytest.fixture(scope="session")
-def event_loop():
-    """Create an instance of the default event loop for the test session."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+# In-process transport shared by every async client; ASGITransport holds no
+# connections, so one instance serves the whole session
+_transport = ASGITransport(app=app)
+
+# Sample audio payloads that meet the minimum size requirement (>1KB).
+# Built once and shared; bytes are immutable so tests can't clobber them.
+_WAV = b"RIFF\x00\x10\x00\x00WAVE" + bytes(4096)  # 4KB of audio data
+_MP3 = b"ID3\x03\x00\x00\x00" + bytes(4096)  # 4KB of audio data
+
+def pytest_configure(config):
+    """Run async tests and fixtures on uvloop when it is installed"""
+    # pytest-asyncio builds every loop from the active policy, so setting it
+    # once covers the whole session without parametrizing tests by loop
+    if UVLOOP_AVAILABLE:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 @pytest.fixture(scope="session")
 async def test_engine():
     """Create test database engine"""
+    # StaticPool keeps a single connection, which an in-memory SQLite
+    # database needs to survive across the whole session
     engine = create_async_engine(
         TEST_DATABASE_URL,
         poolclass=StaticPool,
@@ -40,8 +60,21 @@ async def test_engine():
         echo=False
     )
     
+    # Let SQLAlchemy emit BEGIN itself so SAVEPOINTs nest correctly on SQLite
+    @event.listens_for(engine.sync_engine, "connect")
+    def _disable_driver_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(engine.sync_engine, "begin")
+    def _emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+    
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        
+        # Warm the driver's statement cache so the first test isn't an outlier
+        for statement in ("SELECT 1", "VALUES (0), (1), (2)"):
+            await conn.exec_driver_sql(statement)
     
     yield engine
     
@@ -49,55 +82,67 @@ async def test_engine():
 
 @pytest.fixture
 async def test_db_session(test_engine):
-    """Create test database session"""
-    async_session = async_sessionmaker(
-        test_engine,
-        class_=AsyncSession,
-        expire_on_commit=False
-    )
-    
-    async with async_session() as session:
-        # Clean up all tables at the start of each test
-        await session.execute(text("DELETE FROM audio_features"))
-        await session.execute(text("DELETE FROM user_interactions"))
-        await session.execute(text("DELETE FROM user_preferences"))
-        await session.execute(text("DELETE FROM recommendation_cache"))
-        await session.execute(text("DELETE FROM room_analytics"))
-        await session.execute(text("DELETE FROM ml_models"))
-        await session.commit()
+    """Create test database session rolled back at the end of each test"""
+    async with test_engine.connect() as conn:
+        # Everything the test does, including session.commit(), happens
+        # inside a SAVEPOINT under this outer transaction
+        trans = await conn.begin()
+        session = AsyncSession(
+            bind=conn,
+            expire_on_commit=False,
+            join_transaction_mode="create_savepoint"
+        )
         
         yield session
         
-        # Clean up after test
-        await session.rollback()
+        await session.close()
+        await trans.rollback()
+
+@pytest.fixture(scope="session")
+def app_client():
+    """Create one test client so app startup and lifespan run once per session"""
+    from fastapi.testclient import TestClient
+    
+    with TestClient(app) as client:
+        yield client
 
 @pytest.fixture
-def test_client(test_db_session):
-    """Create test client with database override"""
+def test_client(app_client, test_db_session):
+    """Shared test client with database override for the current test"""
     def override_get_db():
         return test_db_session
     
     app.dependency_overrides[get_db_session] = override_get_db
     
-    with TestClient(app) as client:
-        yield client
+    yield app_client
     
-    app.dependency_overrides.clear()
+    app.dependency_overrides.pop(get_db_session, None)
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def asgi_client():
+    """Create one in-process async client; the app lifespan runs once per session"""
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=_transport, base_url="http://test") as client:
+            yield client
 
 @pytest.fixture
-def sample_audio_data():
-    """Provide sample audio data for testing"""
-    # Create WAV data that meets minimum size requirement (>1KB)
-    wav_header = b"RIFF\x00\x10\x00\x00WAVE"
-    wav_data = wav_header + b"\x00" * 4096  # 4KB of audio data
+def async_client(asgi_client, test_db_session):
+    """Shared async client with database override for the current test"""
+    def override_get_db():
+        return test_db_session
     
-    # Create MP3 data that meets minimum size requirement (>1KB)
-    mp3_header = b"ID3\x03\x00\x00\x00"
-    mp3_data = mp3_header + b"\x00" * 4096  # 4KB of audio data
+    app.dependency_overrides[get_db_session] = override_get_db
     
+    yield asgi_client
+    
+    app.dependency_overrides.pop(get_db_session, None)
+
+@pytest.fixture
+def sample_audio_data():
+    """Provide sample audio data for testing"""
     return {
-        "wav_content": wav_data,
-        "mp3_content": mp3_data,
+        "wav_content": _WAV,
+        "mp3_content": _MP3,
         "filename": "test_audio.wav"
     }
 
@@ -141,19 +186,49 @@ def mock_audio_analyzer():
     }
     return analyzer
 
-@pytest.fixture
-def mock_recommendation_engine():
-    """Mock recommendation engine for testing"""
-    engine = AsyncMock()
-    engine.get_room_recommendations.return_value = [
+# Embedding-like room and user vectors, scored once at import with a single
+# BLAS matrix-vector product the way an ANN backend would rank rooms
+_rng = np.random.default_rng(0)
+_ITEM_VECS = _rng.standard_normal((1000, 64)).astype(np.float32)
+_ITEM_VECS /= np.linalg.norm(_ITEM_VECS, axis=1, keepdims=True)
+_USER_VEC = _rng.standard_normal(64).astype(np.float32)
+_USER_VEC /= np.linalg.norm(_USER_VEC)
+_SCORES = (1.0 + _ITEM_VECS @ _USER_VEC) / 2  # cosine mapped into [0, 1]
+
+@lru_cache(maxsize=None)
+def _scored_recommendations(limit: int) -> tuple:
+    """Top-`limit` rooms by precomputed score, best first"""
+    top = np.argpartition(-_SCORES, limit - 1)[:limit]
+    top = top[np.argsort(-_SCORES[top])]
+    return tuple(
         {
-            "room_id": "test_room_1",
-            "room_name": "Test Room 1",
-            "score": 0.95,
+            "room_id": f"test_room_{i}",
+            "room_name": f"Test Room {i}",
+            "score": float(_SCORES[i]),
             "reasoning": "Test recommendation",
             "participants": 5,
             "genres": ["electronic", "ambient"],
             "metadata": None
         }
-    ]
-    return engine
+        for i in top
+    )
+
+class _StubEngine:
+    """Plain stand-in for RecommendationEngine returning precomputed results"""
+    
+    async def get_room_recommendations(self, user_id, limit=10, **kwargs):
+        return list(_scored_recommendations(limit))
+    
+    async def get_room_recommendations_batch(self, user_ids, limit=10):
+        recommendations = list(_scored_recommendations(limit))
+        return [recommendations for _ in user_ids]
+    
+    async def get_similar_rooms(self, *args, **kwargs):
+        return []
+
+@pytest.fixture(scope="session")
+def mock_recommendation_engine():
+    """Stub recommendation engine shared across the test session"""
+    # Tests needing custom return values or side effects should build their
+    # own AsyncMock rather than mutate this shared instance
+    return _StubEngine()
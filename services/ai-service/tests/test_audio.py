@@ -4,8 +4,7 @@ Test suite for audio analysis endpoints
 
 import pytest
 import io
-from fastapi.testclient import TestClient
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch
 import sys
 from pathlib import Path
 
@@ -101,6 +100,30 @@ class TestAudioAnalysis:
                 assert result["status"] == "success"
                 assert "features" in result
     
+    def test_batch_analyze_dedups_identical_files(self, test_client, sample_audio_data, mock_audio_analyzer):
+        """Test that identical uploads in a batch are only analyzed once"""
+        from routers.audio import get_audio_analyzer, _feature_cache
+        _feature_cache.clear()
+        test_client.app.dependency_overrides[get_audio_analyzer] = lambda: mock_audio_analyzer
+        
+        try:
+            response = test_client.post(
+                "/audio/batch-analyze",
+                files=[
+                    ("files", ("test1.wav", io.BytesIO(sample_audio_data["wav_content"]), "audio/wav")),
+                    ("files", ("test2.wav", io.BytesIO(sample_audio_data["wav_content"]), "audio/wav"))
+                ]
+            )
+            
+            assert response.status_code == 200
+            results = response.json()["results"]
+            assert [r["status"] for r in results] == ["success", "success"]
+            assert results[0]["features"] == results[1]["features"]
+            assert mock_audio_analyzer.extract_features.await_count == 1
+        finally:
+            del test_client.app.dependency_overrides[get_audio_analyzer]
+            _feature_cache.clear()
+    
     def test_batch_analyze_mixed_file_types(self, test_client, sample_audio_data, mock_audio_analyzer):
         """Test batch analysis with mixed valid and invalid files"""
         with patch('routers.audio.get_audio_analyzer', return_value=mock_audio_analyzer):
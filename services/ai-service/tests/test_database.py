@@ -3,16 +3,20 @@ Test suite for database operations
 """
 
 import pytest
-from unittest.mock import AsyncMock
-from sqlalchemy.ext.asyncio import AsyncSession
-from datetime import datetime
+from functools import lru_cache
+from datetime import datetime, timezone
 
 # Import the operations we want to test
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
+from database.models import AudioFeatures
 from database.operations import AudioFeatureService, UserInteractionService, UserPreferencesService
+from database.vector_index import VectorIndex, get_vector_index
+
+# Deterministic timestamp for fixtures that don't assert on time
+_FIXED_TS = datetime(2024, 1, 1, tzinfo=timezone.utc)
 
 
 class TestAudioFeatureService:
@@ -23,17 +27,13 @@ class TestAudioFeatureService:
         """Test saving audio features to database"""
         audio_file_id = "test_audio_123"
         
-        # This should fail due to foreign key constraint (expected)
-        # or succeed if the AudioFile record exists
-        try:
-            await AudioFeatureService.save_audio_features(
-                test_db_session, audio_file_id, sample_features
-            )
-            # If it doesn't raise an exception, that's fine too
-            assert True
-        except Exception as e:
-            # Expected due to foreign key constraint or other DB issues
-            assert True
+        # The schema has no foreign key to AudioFile, so the insert succeeds
+        result = await AudioFeatureService.save_audio_features(
+            test_db_session, audio_file_id, sample_features
+        )
+        await test_db_session.flush()
+        
+        assert result.audioFileId == audio_file_id
     
     @pytest.mark.asyncio
     async def test_get_audio_features_not_found(self, test_db_session):
@@ -54,7 +54,120 @@ class TestAudioFeatureService:
         
         assert isinstance(results, list)
         assert len(results) == 0
+    
+    @pytest.mark.asyncio
+    async def test_get_similar_audio_features_ranked(self, test_db_session, sample_features):
+        """Test that similarity search returns the closest embeddings first"""
+        near = dict(sample_features, feature_vector=[0.1] * 127 + [0.2])
+        far = dict(sample_features, feature_vector=[0.1] * 64 + [-0.1] * 64)
+        await AudioFeatureService.save_audio_features(test_db_session, "far_audio", far)
+        await AudioFeatureService.save_audio_features(test_db_session, "near_audio", near)
+        await test_db_session.commit()
+        
+        results = await AudioFeatureService.get_similar_audio_features(
+            test_db_session, [0.1] * 128, limit=5
+        )
+        assert [f.audioFileId for f in results] == ["near_audio", "far_audio"]
+        
+        results = await AudioFeatureService.get_similar_audio_features(
+            test_db_session, [0.1] * 128, limit=5, exclude_file_id="near_audio"
+        )
+        assert [f.audioFileId for f in results] == ["far_audio"]
 
+    
+    @pytest.mark.asyncio
+    async def test_vector_index_updated_after_commit(self, test_db_session, sample_features):
+        """Test that saved embeddings only become searchable once committed"""
+        vector = [0.3] * 7
+        features = dict(sample_features, feature_vector=vector)
+        await AudioFeatureService.save_audio_features(test_db_session, "committed_audio", features)
+        await test_db_session.flush()
+        assert "committed_audio" not in dict(get_vector_index().search(vector, 5))
+        
+        await test_db_session.commit()
+        assert "committed_audio" in dict(get_vector_index().search(vector, 5))
+    
+    @pytest.mark.asyncio
+    async def test_vector_index_skips_rolled_back_rows(self, test_db_session, sample_features):
+        """Test that a rollback discards the pending index write"""
+        vector = [0.4] * 7
+        features = dict(sample_features, feature_vector=vector)
+        await AudioFeatureService.save_audio_features(test_db_session, "rolled_back_audio", features)
+        await test_db_session.rollback()
+        await test_db_session.commit()
+        
+        assert "rolled_back_audio" not in dict(get_vector_index().search(vector, 5))
+    
+    @pytest.mark.asyncio
+    async def test_get_similar_audio_features_backfills_stale_ids(self, test_db_session, sample_features):
+        """Test that ids with no row are dropped and replaced by live rows"""
+        index = get_vector_index()
+        for i in range(4):
+            index.add(f"ghost_audio_{i}", [0.2] * 8 + [0.01 * i])
+        far = dict(sample_features, feature_vector=[0.2] * 4 + [-0.2] * 5)
+        await AudioFeatureService.save_audio_features(test_db_session, "live_audio", far)
+        await test_db_session.commit()
+        
+        results = await AudioFeatureService.get_similar_audio_features(
+            test_db_session, [0.2] * 9, limit=1
+        )
+        assert [f.audioFileId for f in results] == ["live_audio"]
+        assert not any(file_id.startswith("ghost_audio") for file_id, _ in index.search([0.2] * 9, 10))
+    
+    @pytest.mark.asyncio
+    async def test_get_similar_audio_features_reloads_index(self, test_db_session, monkeypatch):
+        """Test that rows written outside this process show up after a reload"""
+        test_db_session.add(AudioFeatures(audioFileId="external_audio", embeddings=[0.5] * 6))
+        await test_db_session.flush()
+        
+        monkeypatch.setattr(get_vector_index(), "loaded_at", None)
+        results = await AudioFeatureService.get_similar_audio_features(
+            test_db_session, [0.5] * 6, limit=5
+        )
+        assert [f.audioFileId for f in results] == ["external_audio"]
+    
+    @pytest.mark.asyncio
+    async def test_malformed_embeddings_commit_cleanly(self, test_db_session, sample_features):
+        """Test that an unindexable feature vector doesn't fail the commit"""
+        features = dict(sample_features, feature_vector=[[1.0, 2.0], [3.0]])
+        await AudioFeatureService.save_audio_features(test_db_session, "malformed_audio", features)
+        await test_db_session.commit()
+        
+        saved = await AudioFeatureService.get_audio_features(test_db_session, "malformed_audio")
+        assert saved is not None
+    
+    @pytest.mark.asyncio
+    async def test_reload_skips_malformed_embeddings(self, test_db_session, monkeypatch):
+        """Test that one unusable embeddings row doesn't break the reload"""
+        test_db_session.add(AudioFeatures(audioFileId="ragged_audio", embeddings=[[1, 2], [3]]))
+        test_db_session.add(AudioFeatures(audioFileId="text_audio", embeddings=["not", "numbers"]))
+        test_db_session.add(AudioFeatures(audioFileId="usable_audio", embeddings=[0.7] * 5))
+        await test_db_session.flush()
+        
+        index = get_vector_index()
+        monkeypatch.setattr(index, "loaded_at", None)
+        results = await AudioFeatureService.get_similar_audio_features(
+            test_db_session, [0.7] * 5, limit=5
+        )
+        assert [f.audioFileId for f in results] == ["usable_audio"]
+        assert index.loaded_at is not None
+        assert index.begin_reload()
+        index.finish_reload(None)
+    
+    def test_failed_reload_stops_journaling(self):
+        """Test that an error while building the new index ends the reload"""
+        def _items():
+            yield "first_audio", [0.1] * 4
+            raise RuntimeError("row fetch failed")
+        
+        index = VectorIndex()
+        assert index.begin_reload()
+        with pytest.raises(RuntimeError):
+            index.finish_reload(_items())
+        
+        assert index.begin_reload()
+        index.finish_reload([("first_audio", [0.1] * 4)])
+        assert index.loaded_at is not None
 
 class TestUserInteractionService:
     """Test user interaction database operations"""
@@ -67,43 +180,32 @@ class TestUserInteractionService:
             "interaction_type": "join",
             "room_id": "test_room", 
             "duration": 300,
-            "timestamp": datetime.utcnow()
+            "timestamp": _FIXED_TS
         }
         
-        # Try to save interaction - should either succeed or fail with FK constraint
-        try:
-            result = await UserInteractionService.record_interaction(
-                test_db_session, 
-                interaction_data["user_id"],
-                interaction_data["interaction_type"],
-                interaction_data.get("room_id"),
-                None,  # audio_file_id
-                interaction_data.get("duration"),
-                {}  # metadata
-            )
-            # If it succeeds, that's also valid in test environment
-            assert result is not None
-        except Exception as e:
-            # Expected due to foreign key constraints or DB issues
-            assert "foreign key" in str(e).lower() or "constraint" in str(e).lower()
-    
-    @pytest.mark.asyncio
-    async def test_get_user_interactions_empty(self, test_db_session):
-        """Test getting interactions for user with no interactions"""
-        interactions = await UserInteractionService.get_user_interactions(
-            test_db_session, "non_existent_user", limit=10
+        result = await UserInteractionService.record_interaction(
+            test_db_session, 
+            interaction_data["user_id"],
+            interaction_data["interaction_type"],
+            interaction_data.get("room_id"),
+            None,  # audio_file_id
+            interaction_data.get("duration"),
+            {}  # metadata
         )
+        await test_db_session.flush()
         
-        assert isinstance(interactions, list)
-        assert len(interactions) == 0
+        assert result.userId == "test_user"
+        assert result.actionType == "join"
     
     @pytest.mark.asyncio
-    async def test_get_room_interactions_empty(self, test_db_session):
-        """Test getting interactions for room with no interactions"""
-        # Note: get_room_interactions method doesn't exist in current implementation
-        # This test validates the expected behavior
+    @pytest.mark.parametrize("filters", [
+        {},
+        {"interaction_types": ["join", "leave"]},
+    ], ids=["all", "by_type"])
+    async def test_get_interactions_empty(self, test_db_session, filters):
+        """Test getting interactions for user with no interactions"""
         interactions = await UserInteractionService.get_user_interactions(
-            test_db_session, "non_existent_user", limit=10
+            test_db_session, "non_existent_user", limit=10, **filters
         )
         
         assert isinstance(interactions, list)
@@ -120,9 +222,9 @@ class TestUserPreferencesService:
             test_db_session, "non_existent_user"
         )
         
-        # get_or_create_preferences creates if not found, so it should return something
-        # or fail due to foreign key constraint
-        assert preferences is not None or True  # Allow for foreign key failure
+        # get_or_create_preferences creates defaults if not found
+        assert preferences is not None
+        assert preferences.userId == "non_existent_user"
     
     @pytest.mark.asyncio
     async def test_save_preferences(self, test_db_session):
@@ -134,16 +236,12 @@ class TestUserPreferencesService:
             "activityLevel": "medium"
         }
         
-        # Try to save preferences - should either succeed or fail with FK constraint
-        try:
-            result = await UserPreferencesService.update_preferences(
-                test_db_session, "test_user", preferences_data
-            )
-            # If it succeeds, that's also valid in test environment
-            assert result is not None
-        except Exception as e:
-            # Expected due to foreign key constraints or DB issues
-            assert "foreign key" in str(e).lower() or "constraint" in str(e).lower() or "user" in str(e).lower()
+        result = await UserPreferencesService.update_preferences(
+            test_db_session, "test_user", preferences_data
+        )
+        await test_db_session.flush()
+        
+        assert result.userId == "test_user"
     
     @pytest.mark.asyncio
     async def test_update_preferences_not_found(self, test_db_session):
@@ -153,16 +251,14 @@ class TestUserPreferencesService:
             "activityLevel": "high"
         }
         
-        # This should handle gracefully or fail with foreign key constraint
-        try:
-            result = await UserPreferencesService.update_preferences(
-                test_db_session, "non_existent_user", preferences_data
-            )
-            # If it doesn't raise an exception, that's also fine
-            assert True
-        except Exception:
-            # Expected due to foreign key constraints
-            assert True
+        # Missing preferences are created with defaults before the update
+        result = await UserPreferencesService.update_preferences(
+            test_db_session, "non_existent_user", preferences_data
+        )
+        await test_db_session.flush()
+        
+        assert result.userId == "non_existent_user"
+        assert result.interactionCount == 1
 
 
 class TestDatabaseConnectionHandling:
@@ -171,10 +267,9 @@ class TestDatabaseConnectionHandling:
     @pytest.mark.asyncio
     async def test_database_session_context(self, test_db_session):
         """Test that database session works in async context"""
-        # Simple query to test session is working
-        from sqlalchemy import text
-        result = await test_db_session.execute(text("SELECT 1 as test_value"))
-        row = result.fetchone()
+        # Simple query to test session is working; bypasses SQL compilation
+        conn = await test_db_session.connection()
+        row = (await conn.exec_driver_sql("SELECT 1")).fetchone()
         
         assert row is not None
         assert row[0] == 1
@@ -182,25 +277,32 @@ class TestDatabaseConnectionHandling:
     @pytest.mark.asyncio
     async def test_database_transaction_rollback(self, test_db_session):
         """Test transaction rollback behavior"""
-        try:
-            from sqlalchemy import text
-            # Attempt an operation that will fail
+        from sqlalchemy import text
+        from sqlalchemy.exc import DBAPIError
+        
+        # Attempt an operation that will fail
+        with pytest.raises(DBAPIError, match="non_existent_table"):
             await test_db_session.execute(text("SELECT * FROM non_existent_table"))
-            await test_db_session.commit()
-        except Exception:
-            await test_db_session.rollback()
-            # Should not raise an exception
-            pass
+        
+        # Rolling back should not raise and leaves the session usable
+        await test_db_session.rollback()
+        result = await test_db_session.execute(text("SELECT 1"))
+        assert result.scalar() == 1
     
     @pytest.mark.asyncio
     async def test_multiple_operations_same_session(self, test_db_session):
         """Test multiple operations using the same session"""
-        # Test that we can perform multiple queries
-        from sqlalchemy import text
-        for i in range(3):
-            result = await test_db_session.execute(text(f"SELECT {i} as value"))
-            row = result.fetchone()
-            assert row[0] == i
+        # Test that we can perform multiple queries in one round-trip
+        conn = await test_db_session.connection()
+        rows = (await conn.exec_driver_sql("VALUES (0), (1), (2)")).fetchall()
+        assert [row[0] for row in rows] == [0, 1, 2]
+
+
+@lru_cache(maxsize=None)
+def _cols(model):
+    """Mapped attribute names of a model, introspected once per worker"""
+    from sqlalchemy import inspect
+    return frozenset(inspect(model).attrs.keys())
 
 
 class TestDatabaseModelValidation:
@@ -217,8 +319,8 @@ class TestDatabaseModelValidation:
             'mfccFeatures', 'spectralFeatures', 'rhythmFeatures', 'harmonicFeatures'
         ]
         
-        for field in expected_fields:
-            assert hasattr(AudioFeatures, field), f"AudioFeatures missing field: {field}"
+        missing = set(expected_fields) - _cols(AudioFeatures)
+        assert not missing, f"AudioFeatures missing fields: {sorted(missing)}"
     
     def test_user_interactions_model_structure(self):
         """Test that UserInteraction model has expected fields"""
@@ -229,8 +331,8 @@ class TestDatabaseModelValidation:
             'duration', 'timestamp', 'rating', 'sessionId'
         ]
         
-        for field in expected_fields:
-            assert hasattr(UserInteraction, field), f"UserInteraction missing field: {field}"
+        missing = set(expected_fields) - _cols(UserInteraction)
+        assert not missing, f"UserInteraction missing fields: {sorted(missing)}"
     
     def test_user_preferences_model_structure(self):
         """Test that UserPreferences model has expected fields"""
@@ -241,5 +343,5 @@ class TestDatabaseModelValidation:
             'tempoRange', 'lastUpdated', 'discoveryMode', 'confidenceScore'
         ]
         
-        for field in expected_fields:
-            assert hasattr(UserPreferences, field), f"UserPreferences missing field: {field}"
+        missing = set(expected_fields) - _cols(UserPreferences)
+        assert not missing, f"UserPreferences missing fields: {sorted(missing)}"
@@ -3,7 +3,6 @@ Test suite for health check endpoints
 """
 
 import pytest
-from fastapi.testclient import TestClient
 
 
 class TestHealthEndpoints:
@@ -3,65 +3,101 @@ Integration test for SyncSphere AI Service
 Tests complete workflow: service startup -> health check -> audio analysis -> recommendations
 """
 
+import asyncio
 import pytest
+import pytest_asyncio
+import httpx
 import requests
-import io
 import time
+from statistics import median
 from pathlib import Path
 
 # Test configuration
 AI_SERVICE_URL = "http://localhost:8004"
 TIMEOUT = 30  # seconds to wait for service startup
 
-class TestAIServiceIntegration:
-    """Integration tests for the complete AI service workflow"""
+# WAV uploads that meet the 1KB minimum size requirement, built once
+_WAV_HEADER = b"RIFF\x00\x10\x00\x00WAVE"
+_WAV_BYTES = _WAV_HEADER + bytes(4096)  # 4KB of audio data
+_WAV_BYTES_LARGE = _WAV_HEADER + bytes(64 * 1024)  # 64KB of audio data
+
+async def wait_for_service(client: httpx.AsyncClient):
+    """Wait for AI service to be available"""
+    # Poll quickly at first, backing off exponentially to at most 1s
+    delay = 0.05
+    deadline = time.monotonic() + TIMEOUT
+    first_attempt = True
     
-    @classmethod
-    def setup_class(cls):
-        """Ensure AI service is running before tests"""
-        cls.wait_for_service()
+    while time.monotonic() < deadline:
+        try:
+            response = await client.get("/health/", timeout=2)
+            if response.status_code == 200:
+                print(f"✅ AI Service is running and responding")
+                return
+        except httpx.HTTPError:
+            pass
+        
+        if first_attempt:
+            print("⏳ Waiting for AI service to start...")
+            first_attempt = False
+        
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
     
-    @classmethod
-    def wait_for_service(cls):
-        """Wait for AI service to be available"""
-        for attempt in range(TIMEOUT):
-            try:
-                response = requests.get(f"{AI_SERVICE_URL}/health/", timeout=5)
-                if response.status_code == 200:
-                    print(f"✅ AI Service is running and responding")
-                    return
-            except requests.exceptions.RequestException:
-                pass
-            
-            if attempt == 0:
-                print("⏳ Waiting for AI service to start...")
-            
-            time.sleep(1)
-        
-        pytest.skip("AI service is not running. Start it with: ./start_ai_service.sh")
+    pytest.skip("AI service is not running. Start it with: ./start_ai_service.sh")
+
+@pytest_asyncio.fixture(scope="class", loop_scope="class")
+async def ai_client():
+    """Keep-alive async client shared by every test in the class"""
+    async with httpx.AsyncClient(base_url=AI_SERVICE_URL, timeout=5) as client:
+        await wait_for_service(client)
+        yield client
+
+@pytest.mark.asyncio(loop_scope="class")
+class TestAIServiceIntegration:
+    """Integration tests for the complete AI service workflow"""
     
-    def test_service_health(self):
+    async def test_service_health(self, ai_client):
         """Test service health endpoints"""
-        # Basic health check
-        response = requests.get(f"{AI_SERVICE_URL}/health/")
+        # Basic and detailed health checks are independent, issue them together
+        response, detailed_response = await asyncio.gather(
+            ai_client.get("/health/"),
+            ai_client.get("/health/detailed")
+        )
+        
         assert response.status_code == 200
         
         data = response.json()
         assert data["status"] == "healthy"
         assert data["service"] == "ai-service"
         
-        # Detailed health check
-        response = requests.get(f"{AI_SERVICE_URL}/health/detailed")
-        assert response.status_code == 200
+        assert detailed_response.status_code == 200
         
-        data = response.json()
+        data = detailed_response.json()
         assert data["status"] == "healthy"
         assert "system" in data
         assert "environment" in data
     
-    def test_root_endpoint(self):
+    async def test_health_and_root_parallel(self, ai_client):
+        """Test that independent read-only probes succeed when issued concurrently"""
+        health, detailed, root = await asyncio.gather(
+            ai_client.get("/health/"),
+            ai_client.get("/health/detailed"),
+            ai_client.get("/")
+        )
+        
+        assert health.status_code == 200
+        assert health.json()["status"] == "healthy"
+        
+        assert detailed.status_code == 200
+        assert "system" in detailed.json()
+        
+        assert root.status_code == 200
+        assert root.json()["status"] == "running"
+    
+    async def test_root_endpoint(self, ai_client):
         """Test service root endpoint"""
-        response = requests.get(f"{AI_SERVICE_URL}/")
+        response = await ai_client.get("/")
         assert response.status_code == 200
         
         data = response.json()
@@ -69,16 +105,13 @@ class TestAIServiceIntegration:
         assert data["status"] == "running"
         assert "endpoints" in data
     
-    def test_audio_analysis_workflow(self):
+    @pytest.mark.parametrize("wav_bytes", [_WAV_BYTES, _WAV_BYTES_LARGE], ids=["4KB", "64KB"])
+    async def test_audio_analysis_workflow(self, ai_client, wav_bytes):
         """Test complete audio analysis workflow"""
-        # Create a larger WAV file that meets the 1KB minimum requirement
-        wav_header = b"RIFF\x00\x10\x00\x00WAVE"
-        wav_data = wav_header + b"\x00" * 4096  # 4KB of audio data
-        
-        # Test audio analysis
-        files = {"file": ("test.wav", io.BytesIO(wav_data), "audio/wav")}
+        # Pass bytes directly so they are sent without a BytesIO copy
+        files = {"file": ("test.wav", wav_bytes, "audio/wav")}
         
-        response = requests.post(f"{AI_SERVICE_URL}/audio/analyze", files=files)
+        response = await ai_client.post("/audio/analyze", files=files)
         
         # Should either succeed or fail gracefully
         assert response.status_code in [200, 500]
@@ -88,12 +121,12 @@ class TestAIServiceIntegration:
             assert "filename" in data
             assert data["filename"] == "test.wav"
     
-    def test_recommendations_workflow(self):
+    async def test_recommendations_workflow(self, ai_client):
         """Test recommendations workflow"""
         # Test room recommendations
         params = {"user_id": "integration_test_user", "limit": 3}
         
-        response = requests.post(f"{AI_SERVICE_URL}/recommendations/rooms", params=params)
+        response = await ai_client.post("/recommendations/rooms", params=params)
         assert response.status_code == 200
         
         data = response.json()
@@ -106,60 +139,72 @@ class TestAIServiceIntegration:
             for field in required_fields:
                 assert field in recommendation
     
-    def test_database_connectivity(self):
+    async def test_database_connectivity(self, ai_client):
         """Test database connectivity through API"""
-        # Test user preferences endpoint (should handle gracefully if user doesn't exist)
-        response = requests.get(f"{AI_SERVICE_URL}/recommendations/preferences/test_user")
-        
-        # Should return 404 (user not found) or 500 (database error) - both indicate connectivity
-        assert response.status_code in [404, 500]
+        # Test user preferences and analytics endpoints (should handle gracefully if user doesn't exist)
+        response, analytics_response = await asyncio.gather(
+            ai_client.get("/recommendations/preferences/test_user"),
+            ai_client.get("/recommendations/analytics/user/test_user")
+        )
         
-        # Test analytics endpoint
-        response = requests.get(f"{AI_SERVICE_URL}/recommendations/analytics/user/test_user")
-        assert response.status_code in [200, 404, 500]
+        # Unknown users get default preferences and an empty report
+        assert response.status_code == 200
+        assert analytics_response.status_code == 200
     
-    def test_error_handling(self):
+    async def test_error_handling(self, ai_client):
         """Test service error handling"""
-        # Test invalid audio file
-        invalid_file = {"file": ("test.txt", io.BytesIO(b"not audio"), "text/plain")}
+        # Invalid audio file and invalid recommendations request
+        invalid_file = {"file": ("test.txt", b"not audio", "text/plain")}
+        
+        response, rec_response = await asyncio.gather(
+            ai_client.post("/audio/analyze", files=invalid_file),
+            ai_client.post("/recommendations/rooms")
+        )
         
-        response = requests.post(f"{AI_SERVICE_URL}/audio/analyze", files=invalid_file)
         assert response.status_code == 400
         
         error_data = response.json()
         assert "File must be an audio file" in error_data["detail"]
         
-        # Test invalid recommendations request
-        response = requests.post(f"{AI_SERVICE_URL}/recommendations/rooms")
-        assert response.status_code == 422  # Missing required parameters
+        assert rec_response.status_code == 422  # Missing required parameters
+
+
+@pytest.fixture(scope="class")
+def http():
+    """Keep-alive session so TCP setup stays out of the measured path"""
+    with requests.Session() as session:
+        yield session
+
+def median_latency(call, runs: int = 5) -> float:
+    """Median wall time in seconds of `runs` calls, after one warmup call"""
+    response = call()
+    assert response.status_code == 200
+    
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter_ns()
+        response = call()
+        timings.append(time.perf_counter_ns() - start)
+        assert response.status_code == 200
+    return median(timings) / 1e9
 
 
 class TestServicePerformance:
     """Performance tests for the AI service"""
     
-    def test_health_check_performance(self):
+    def test_health_check_performance(self, http):
         """Test health check response time"""
-        start_time = time.time()
+        response_time = median_latency(lambda: http.get(f"{AI_SERVICE_URL}/health/"))
         
-        response = requests.get(f"{AI_SERVICE_URL}/health/")
-        
-        end_time = time.time()
-        response_time = end_time - start_time
-        
-        assert response.status_code == 200
         assert response_time < 1.0, f"Health check took {response_time:.2f}s, should be < 1.0s"
     
-    def test_recommendations_performance(self):
+    def test_recommendations_performance(self, http):
         """Test recommendations response time"""
-        start_time = time.time()
-        
         params = {"user_id": "perf_test_user", "limit": 5}
-        response = requests.post(f"{AI_SERVICE_URL}/recommendations/rooms", params=params)
-        
-        end_time = time.time()
-        response_time = end_time - start_time
+        response_time = median_latency(
+            lambda: http.post(f"{AI_SERVICE_URL}/recommendations/rooms", params=params)
+        )
         
-        assert response.status_code == 200
         assert response_time < 2.0, f"Recommendations took {response_time:.2f}s, should be < 2.0s"
 
 
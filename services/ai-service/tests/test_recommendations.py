@@ -2,218 +2,415 @@
 Test suite for recommendation endpoints
 """
 
+import asyncio
+import fastjsonschema
+import orjson
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import patch, AsyncMock
+from types import MappingProxyType
+from urllib.parse import urlencode
+from unittest.mock import AsyncMock, MagicMock
+
+from main import app
+from routers.recommendations import _RecommendationBatcher, _batcher, get_recommendation_engine
+from services.recommendation_engine import RecommendationEngine
+
+# Share the session loop with the async_client fixture
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+ROOMS_URL = "/recommendations/rooms"
+
+# Edge-case user ids, built once at import
+_LONG_UID = "a" * 1000
+_SPECIAL_UID = "user@test!#$%"
+
+# Read-only similar-rooms payload shared by every call
+_SIMILAR_ROOMS = (
+    MappingProxyType({
+        "room_id": "similar_room_1",
+        "room_name": "Similar Room 1",
+        "similarity_score": 0.85,
+        "genres": ("electronic", "ambient")
+    }),
+)
+
+# /rooms serializes engine output with orjson directly, so this stays a dict
+_CACHED_ROOM = {
+    "room_id": "cached_room_1",
+    "room_name": "Cached Room 1",
+    "score": 0.9,
+    "reasoning": "Cached",
+    "participants": 2,
+    "genres": ["jazz"]
+}
+
+def _batch_of(*recommendations):
+    """side_effect for get_room_recommendations_batch returning the same list per user"""
+    def _batch(user_ids, limit):
+        return [list(recommendations) for _ in user_ids]
+    return _batch
+
+# Compiled once; checks a whole /rooms response in a single call
+_validate_recommendations = fastjsonschema.compile({
+    "type": "array",
+    "items": {
+        "type": "object",
+        "required": ["room_id", "room_name", "score", "reasoning"]
+    }
+})
+
+# Request bodies are serialized with orjson and sent as raw content
+_JSON_HEADERS = {"content-type": "application/json"}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _patch_engine(mock_recommendation_engine):
+    """Serve every request in this module from the stub engine"""
+    app.dependency_overrides[get_recommendation_engine] = lambda: mock_recommendation_engine
+    yield
+    app.dependency_overrides.pop(get_recommendation_engine, None)
+
+@pytest.fixture
+def use_engine(mock_recommendation_engine):
+    """Swap in a custom engine for one test, restoring the stub afterwards"""
+    def _use(engine):
+        app.dependency_overrides[get_recommendation_engine] = lambda: engine
+    
+    yield _use
+    
+    app.dependency_overrides[get_recommendation_engine] = lambda: mock_recommendation_engine
+
+async def _asgi_status(method: str, path: str, params: dict) -> int:
+    """Call the ASGI app directly and return the response status code"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": urlencode(params).encode(),
+        "headers": [(b"host", b"test")],
+        "client": ("127.0.0.1", 123),
+        "server": ("test", 80),
+    }
+    messages = []
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        messages.append(message)
+    
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
 
 
 class TestRecommendationEndpoints:
     """Test recommendation functionality"""
     
-    def test_get_room_recommendations_success(self, test_client, mock_recommendation_engine):
+    async def test_get_room_recommendations_success(self, async_client):
         """Test successful room recommendations"""
-        with patch('routers.recommendations.get_recommendation_engine', return_value=mock_recommendation_engine):
-            response = test_client.post("/recommendations/rooms?user_id=test_user&limit=5")
-            
-            assert response.status_code == 200
-            data = response.json()
-            
-            assert isinstance(data, list)
-            assert len(data) <= 5
-            
-            if data:  # If recommendations returned
-                recommendation = data[0]
-                required_fields = ["room_id", "room_name", "score", "reasoning"]
-                for field in required_fields:
-                    assert field in recommendation
-    
-    def test_get_room_recommendations_invalid_limit(self, test_client):
-        """Test room recommendations with invalid limit"""
-        # Test limit too high
-        response = test_client.post("/recommendations/rooms?user_id=test_user&limit=100")
-        assert response.status_code == 422  # Validation error
-        
-        # Test limit too low
-        response = test_client.post("/recommendations/rooms?user_id=test_user&limit=0")
-        assert response.status_code == 422  # Validation error
-    
-    def test_get_room_recommendations_missing_user_id(self, test_client):
-        """Test room recommendations without user_id"""
-        response = test_client.post("/recommendations/rooms")
-        assert response.status_code == 422  # Missing required parameter
-    
-    def test_get_similar_rooms(self, test_client, mock_recommendation_engine):
-        """Test similar rooms endpoint"""
-        mock_recommendation_engine.get_similar_rooms.return_value = [
-            {
-                "room_id": "similar_room_1",
-                "room_name": "Similar Room 1",
-                "similarity_score": 0.85,
-                "genres": ["electronic", "ambient"]
-            }
+        response = await async_client.post(ROOMS_URL, params={"user_id": "test_user", "limit": 5})
+        
+        assert response.status_code == 200
+        data = response.json()
+        
+        assert len(data) <= 5
+        _validate_recommendations(data)
+        
+        # The stub ranks rooms by score, and the router must keep that order
+        scores = [rec["score"] for rec in data]
+        assert scores == sorted(scores, reverse=True)
+    
+    async def test_rooms_response_matches_schema_fields(self, async_client, use_engine):
+        """Test that /rooms items carry exactly the RecommendationResponse fields"""
+        engine = AsyncMock()
+        engine.get_room_recommendations.return_value = [
+            dict(_CACHED_ROOM, score=1.2, tempo_range=[90, 140], energy_level=0.5)
         ]
+        use_engine(engine)
         
-        with patch('routers.recommendations.get_recommendation_engine', return_value=mock_recommendation_engine):
-            response = test_client.post("/recommendations/similar-rooms/test_room_123?limit=5")
-            
-            assert response.status_code == 200
-            data = response.json()
-            assert isinstance(data, list)
+        response = await async_client.post(ROOMS_URL, params={"user_id": "contract_user", "limit": 5})
+        
+        assert response.status_code == 200
+        (item,) = response.json()
+        assert set(item) == {
+            "room_id", "room_name", "score", "reasoning", "participants", "genres", "metadata"
+        }
+        assert item["metadata"] is None
+        assert item["score"] == 1.0
     
-    def test_record_user_interaction(self, test_client):
+    @pytest.mark.parametrize("params,code", [
+        ({"user_id": "test_user", "limit": 100}, 422),  # limit too high
+        ({"user_id": "test_user", "limit": 0}, 422),  # limit too low
+        ({}, 422),  # missing required user_id
+    ], ids=["limit_too_high", "limit_too_low", "missing_user_id"])
+    async def test_get_room_recommendations_validation(self, async_client, params, code):
+        """Test room recommendations with invalid query parameters"""
+        # async_client is only requested for its lifespan and DB override
+        assert await _asgi_status("POST", ROOMS_URL, params) == code
+    
+    async def test_get_similar_rooms(self, async_client, use_engine):
+        """Test similar rooms endpoint"""
+        similar_engine = AsyncMock()
+        similar_engine.get_similar_rooms.return_value = _SIMILAR_ROOMS
+        use_engine(similar_engine)
+        
+        response = await async_client.post("/recommendations/similar-rooms/test_room_123?limit=5")
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data, list)
+        assert data[0]["room_id"] == "similar_room_1"
+    
+    async def test_record_user_interaction(self, async_client):
         """Test recording user interaction"""
-        interaction_data = {
+        # The endpoint takes its fields as query parameters
+        interaction_params = {
             "user_id": "test_user",
             "room_id": "test_room",
             "interaction_type": "join",
             "duration": 300
         }
         
-        response = test_client.post("/recommendations/interactions", json=interaction_data)
+        response = await async_client.post("/recommendations/interactions", params=interaction_params)
         
-        # Should handle gracefully - 422 means validation error, which is expected
-        assert response.status_code in [200, 422, 500]
+        # Written to the in-memory test database, so this always succeeds
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
     
-    def test_get_user_preferences_not_found(self, test_client):
+    async def test_get_user_preferences_not_found(self, async_client):
         """Test getting preferences for non-existent user"""
-        response = test_client.get("/recommendations/preferences/non_existent_user")
+        response = await async_client.get("/recommendations/preferences/non_existent_user")
         
-        # Could return 200 with default preferences, 404, or 500
-        assert response.status_code in [200, 404, 500]
+        # Missing preferences are created with defaults
+        assert response.status_code == 200
+        assert response.json()["user_id"] == "non_existent_user"
     
-    def test_update_user_preferences(self, test_client):
+    async def test_update_user_preferences(self, async_client):
         """Test updating user preferences"""
         preferences_data = {
             "preferred_genres": ["electronic", "jazz", "classical"],
             "preferred_tempo_range": [120, 140],
-            "preferred_instruments": ["piano", "synthesizer"],
             "activity_level": "high"
         }
         
-        response = test_client.put("/recommendations/preferences/test_user", json=preferences_data)
+        response = await async_client.put(
+            "/recommendations/preferences/test_user",
+            content=orjson.dumps(preferences_data),
+            headers=_JSON_HEADERS
+        )
         
-        # Should handle gracefully even if DB operation fails
-        assert response.status_code in [200, 500]
+        assert response.status_code == 200
+        assert response.json()["user_id"] == "test_user"
     
-    def test_get_user_analytics(self, test_client):
+    async def test_get_user_analytics(self, async_client):
         """Test user analytics endpoint"""
-        response = test_client.get("/recommendations/analytics/user/test_user")
+        response = await async_client.get("/recommendations/analytics/user/test_user")
         
-        # Should handle gracefully even if user doesn't exist
-        assert response.status_code in [200, 404, 500]
+        # A user with no history still gets an empty report
+        assert response.status_code == 200
+        assert response.json()["total_interactions"] == 0
     
-    def test_submit_feedback(self, test_client):
+    async def test_submit_feedback(self, async_client):
         """Test feedback submission"""
-        feedback_data = {
+        # The endpoint takes its fields as query parameters
+        feedback_params = {
             "user_id": "test_user",
             "room_id": "test_room",
             "rating": 4,
-            "feedback_type": "recommendation",
-            "comments": "Great recommendation!"
+            "feedback_type": "like"
         }
         
-        response = test_client.post("/recommendations/feedback", json=feedback_data)
+        response = await async_client.post("/recommendations/feedback", params=feedback_params)
         
-        # 422 means validation error, which is acceptable
-        assert response.status_code in [200, 422, 500]
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
     
-    def test_get_user_stats(self, test_client):
+    async def test_get_user_stats(self, async_client):
         """Test user statistics endpoint"""
-        response = test_client.get("/recommendations/stats/test_user")
+        response = await async_client.get("/recommendations/stats/test_user")
         
-        # Should handle gracefully even if user doesn't exist
-        assert response.status_code in [200, 404, 500]
+        # A user with no history still gets stats
+        assert response.status_code == 200
+        assert response.json()["total_interactions_week"] == 0
 
 
 class TestRecommendationEdgeCases:
     """Test edge cases and error conditions"""
     
-    def test_recommendation_engine_failure(self, test_client):
+    async def test_recommendation_engine_failure(self, async_client, use_engine):
         """Test behavior when recommendation engine fails"""
-        failing_engine = AsyncMock()
-        failing_engine.get_room_recommendations.side_effect = Exception("Engine failure")
+        async def _boom(*args, **kwargs):
+            raise RuntimeError("Engine failure")
         
-        with patch('routers.recommendations.get_recommendation_engine', return_value=failing_engine):
-            response = test_client.post("/recommendations/rooms?user_id=test_user&limit=5")
-            
-            # Could return 200 with fallback recommendations or 500 with error
-            assert response.status_code in [200, 500]
+        failing_engine = MagicMock()
+        failing_engine.get_room_recommendations = _boom
+        use_engine(failing_engine)
+        
+        response = await async_client.post(ROOMS_URL, params={"user_id": "test_user", "limit": 5})
+        
+        # Engine errors surface as a 500 rather than an empty 200
+        assert response.status_code == 500
+        assert "Engine failure" in response.json()["detail"]
     
-    def test_large_user_id(self, test_client, mock_recommendation_engine):
+    async def test_large_user_id(self, async_client):
         """Test recommendation with very long user ID"""
-        long_user_id = "a" * 1000
+        response = await async_client.post(ROOMS_URL, params={"user_id": _LONG_UID, "limit": 5})
         
-        with patch('routers.recommendations.get_recommendation_engine', return_value=mock_recommendation_engine):
-            response = test_client.post(f"/recommendations/rooms?user_id={long_user_id}&limit=5")
-            
-            # Should handle gracefully
-            assert response.status_code in [200, 400, 500]
+        assert response.status_code == 200
     
-    def test_special_characters_in_user_id(self, test_client, mock_recommendation_engine):
+    async def test_special_characters_in_user_id(self, async_client):
         """Test recommendation with special characters in user ID"""
-        special_user_id = "user@test!#$%"
+        # httpx percent-encodes the special characters
+        response = await async_client.post(ROOMS_URL, params={"user_id": _SPECIAL_UID, "limit": 5})
         
-        with patch('routers.recommendations.get_recommendation_engine', return_value=mock_recommendation_engine):
-            # URL encode the special characters
-            encoded_user_id = "user%40test%21%23%24%25"
-            response = test_client.post(f"/recommendations/rooms?user_id={encoded_user_id}&limit=5")
-            
-            assert response.status_code in [200, 400, 500]
+        assert response.status_code == 200
 
 
 class TestRecommendationIntegration:
     """Integration tests for recommendation workflows"""
     
-    def test_complete_recommendation_workflow(self, test_client, mock_recommendation_engine):
+    async def test_complete_recommendation_workflow(self, async_client):
         """Test complete workflow: preferences → recommendations → feedback"""
-        with patch('routers.recommendations.get_recommendation_engine', return_value=mock_recommendation_engine):
-            user_id = "workflow_test_user"
-            
-            # 1. Set user preferences
-            preferences = {
-                "genre_preferences": ["jazz", "blues"],  # Use valid key
-                "tempo_range": [80, 120],  # Use valid key
-                "discovery_mode": "balanced"  # Use valid key
+        user_id = "workflow_test_user"
+        
+        # 1. Set user preferences
+        preferences = {
+            "genre_preferences": ["jazz", "blues"],  # Use valid key
+            "tempo_range": [80, 120],  # Use valid key
+            "discovery_mode": "balanced"  # Use valid key
+        }
+        
+        # 2. Get recommendations; independent of step 1, so run both at once
+        prefs_response, rec_response = await asyncio.gather(
+            async_client.put(f"/recommendations/preferences/{user_id}", content=orjson.dumps(preferences), headers=_JSON_HEADERS),
+            async_client.post(ROOMS_URL, params={"user_id": user_id, "limit": 3})
+        )
+        assert prefs_response.status_code == 200
+        assert rec_response.status_code == 200
+        
+        recommendations = rec_response.json()
+        _validate_recommendations(recommendations)
+        
+        # 3. Submit feedback (if recommendations exist)
+        if recommendations:
+            # Use query parameters instead of JSON body for feedback endpoint
+            feedback_params = {
+                "user_id": user_id,
+                "room_id": recommendations[0]["room_id"],
+                "rating": 5,
+                "feedback_type": "like"
             }
             
-            prefs_response = test_client.put(f"/recommendations/preferences/{user_id}", json=preferences)
-            assert prefs_response.status_code in [200, 422, 500]
-            
-            # 2. Get recommendations
-            rec_response = test_client.post(f"/recommendations/rooms?user_id={user_id}&limit=3")
-            assert rec_response.status_code == 200
-            
-            recommendations = rec_response.json()
-            assert isinstance(recommendations, list)
-            
-            # 3. Submit feedback (if recommendations exist)
-            if recommendations:
-                # Use query parameters instead of JSON body for feedback endpoint
-                feedback_params = {
-                    "user_id": user_id,
-                    "room_id": recommendations[0]["room_id"],
-                    "rating": 5,
-                    "feedback_type": "like"
-                }
-                
-                feedback_response = test_client.post("/recommendations/feedback", params=feedback_params)
-                assert feedback_response.status_code in [200, 500]
-    
-    def test_recommendation_caching_behavior(self, test_client, mock_recommendation_engine):
-        """Test that repeated requests handle caching appropriately"""
-        with patch('routers.recommendations.get_recommendation_engine', return_value=mock_recommendation_engine):
-            user_id = "cache_test_user"
+            feedback_response = await async_client.post("/recommendations/feedback", params=feedback_params)
+            assert feedback_response.status_code == 200
+    
+    @pytest.mark.parametrize("n_requests", [3, 10])
+    async def test_recommendation_caching_behavior(self, async_client, use_engine, n_requests):
+        """Test that repeated identical requests are served from the router cache"""
+        engine = AsyncMock()
+        engine.get_room_recommendations.return_value = [_CACHED_ROOM]
+        use_engine(engine)
+        user_id = "cache_test_user"
+        
+        # Make multiple identical requests concurrently
+        responses = await asyncio.gather(*(
+            async_client.post(ROOMS_URL, params={"user_id": user_id, "limit": 5})
+            for _ in range(n_requests)
+        ))
+        
+        for response in responses:
+            assert response.status_code == 200
             
-            # Make multiple identical requests
-            for i in range(3):
-                response = test_client.post(f"/recommendations/rooms?user_id={user_id}&limit=5")
-                assert response.status_code == 200
-                
-                data = response.json()
-                assert isinstance(data, list)
-                
-                # Verify response structure is consistent
-                if data:
-                    for rec in data:
-                        assert "room_id" in rec
-                        assert "score" in rec
+            # Verify response structure is consistent
+            _validate_recommendations(response.json())
+        
+        # Only the first request reached the engine
+        assert engine.get_room_recommendations.call_count == 1
+    
+    async def test_micro_batching_coalesces_requests(self, async_client, use_engine, monkeypatch):
+        """Test that concurrent requests for different users share engine calls"""
+        monkeypatch.setattr(_batcher, "window", 0.005)
+        engine = AsyncMock()
+        engine.get_room_recommendations_batch.side_effect = _batch_of(_CACHED_ROOM)
+        use_engine(engine)
+        
+        responses = await asyncio.gather(*(
+            async_client.post(ROOMS_URL, params={"user_id": f"batch_user_{i}", "limit": 5})
+            for i in range(16)
+        ))
+        
+        for response in responses:
+            assert response.status_code == 200
+            _validate_recommendations(response.json())
+        
+        assert engine.get_room_recommendations_batch.call_count < 16
+        batched_users = [
+            user_id
+            for call in engine.get_room_recommendations_batch.call_args_list
+            for user_id in call.args[0]
+        ]
+        assert sorted(batched_users) == sorted(f"batch_user_{i}" for i in range(16))
+
+
+class TestRecommendationBatcher:
+    """Test that a misbehaving batch never leaves a request waiting"""
+    
+    async def test_short_batch_fails_every_waiter(self):
+        """Test that a batch with fewer results than users fails all of them"""
+        engine = AsyncMock()
+        engine.get_room_recommendations_batch.return_value = [[_CACHED_ROOM]]
+        batcher = _RecommendationBatcher(window=0.001)
+        
+        results = await asyncio.wait_for(asyncio.gather(
+            batcher.submit(engine, "short_a", 5),
+            batcher.submit(engine, "short_b", 5),
+            return_exceptions=True
+        ), timeout=1)
+        
+        assert all(isinstance(result, RuntimeError) for result in results)
+    
+    async def test_per_user_failure_is_isolated(self):
+        """Test that one user's failure does not fail the rest of the batch"""
+        engine = AsyncMock()
+        engine.get_room_recommendations_batch.return_value = [ValueError("bad user"), [_CACHED_ROOM]]
+        batcher = _RecommendationBatcher(window=0.001)
+        
+        bad, good = await asyncio.wait_for(asyncio.gather(
+            batcher.submit(engine, "bad_user", 5),
+            batcher.submit(engine, "good_user", 5),
+            return_exceptions=True
+        ), timeout=1)
+        
+        assert isinstance(bad, ValueError)
+        assert good == [_CACHED_ROOM]
+    
+    async def test_cancelled_batch_fails_waiters(self):
+        """Test that a cancelled engine call still resolves every waiter"""
+        engine = AsyncMock()
+        engine.get_room_recommendations_batch.side_effect = asyncio.CancelledError()
+        batcher = _RecommendationBatcher(window=0.001)
+        
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(batcher.submit(engine, "cancelled_user", 5), timeout=1)
+
+
+class TestRecommendationEngineCache:
+    """Test that cached engine lookups can't be mutated by callers"""
+    
+    @pytest.mark.parametrize("method", ["get_user_preferences", "get_user_stats"])
+    async def test_cached_lookup_is_read_only(self, method):
+        """Test that a caller can't change the value later callers get"""
+        engine = RecommendationEngine()
+        first = await getattr(engine, method)("readonly_user")
+        
+        with pytest.raises(TypeError):
+            first["user_id"] = "someone_else"
+        assert all(not isinstance(value, (list, dict)) for value in first.values())
+        
+        second = await getattr(engine, method)("readonly_user")
+        assert second["user_id"] == "readonly_user"
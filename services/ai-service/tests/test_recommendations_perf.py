@@ -0,0 +1,64 @@
+"""
+Latency budgets for recommendation endpoints
+
+Kept apart from test_recommendations.py because these tests are synchronous
+and drive the app through TestClient rather than the session event loop.
+Calls are timed directly so the budgets are enforced under xdist too.
+"""
+
+import gc
+import itertools
+import time
+from statistics import median
+
+import pytest
+from async_lru import alru_cache
+
+import routers.recommendations as recommendations
+from main import app
+from routers.recommendations import get_recommendation_engine
+
+ROOMS_URL = "/recommendations/rooms"
+
+# Median latency budget for one /rooms request, in seconds, over warm calls
+_ROOMS_BUDGET = 0.02
+_ROOMS_RUNS = 20
+
+
+@pytest.fixture
+def rooms_client(test_client, mock_recommendation_engine, monkeypatch):
+    """TestClient serving /rooms from the stub engine with a cache of its own"""
+    # A fresh cache binds to the TestClient loop instead of tripping
+    # async_lru's loop-change reset on the shared one
+    monkeypatch.setattr(
+        recommendations,
+        "_cached_room_recommendations",
+        alru_cache(maxsize=1024, ttl=60)(recommendations._cached_room_recommendations.__wrapped__)
+    )
+    app.dependency_overrides[get_recommendation_engine] = lambda: mock_recommendation_engine
+    yield test_client
+    app.dependency_overrides.pop(get_recommendation_engine, None)
+
+
+def test_rooms_perf(rooms_client):
+    """Check uncached room recommendations against the latency budget"""
+    # A new user every call so each one misses the router cache
+    user_ids = (f"perf_user_{i}" for i in itertools.count())
+    
+    def _post():
+        return rooms_client.post(ROOMS_URL, params={"user_id": next(user_ids), "limit": 5})
+    
+    # One warmup call, then the median of warm calls with GC pauses kept out
+    assert _post().status_code == 200
+    timings = []
+    gc.disable()
+    try:
+        for _ in range(_ROOMS_RUNS):
+            start = time.perf_counter_ns()
+            response = _post()
+            timings.append(time.perf_counter_ns() - start)
+            assert response.status_code == 200
+    finally:
+        gc.enable()
+    
+    assert median(timings) / 1e9 < _ROOMS_BUDGET